@@ -1,11 +1,17 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import csv
 import logging
 import argparse
+import calendar
+import json
 from datetime import datetime, timedelta, timezone
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 import os
+import time
 
 # Configure logging
 logging.basicConfig(
@@ -18,135 +24,270 @@ load_dotenv()
 API_TOKEN = os.getenv("API_TOKEN")
 
 BASE_URL = "https://api.cloudsmith.io/v1"
+MAX_WORKERS = 32
+CACHE_FILE = ".cloudsmith_metrics_cache.json"
+ENTITLEMENTS_CACHE_TTL = 24 * 60 * 60  # seconds
+# Entitlement fields kept in the cache; others (such as the secret token value) are never written to disk
+ENTITLEMENT_CACHE_FIELDS = ("slug_perm", "name", "created_at")
+# Days after a month ends before its totals are cached, to allow for late aggregation
+METRICS_CACHE_GRACE_DAYS = 3
+
+# Shared session so repeated calls to the API reuse pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.headers["Authorization"] = f"Bearer {API_TOKEN}"
+
+def configure_session(pool_size=MAX_WORKERS):
+    """
+    Mount a retrying HTTPS adapter on the shared session, with a connection
+    pool large enough to keep one connection alive per concurrent request.
+    """
+    SESSION.mount("https://", HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        # raise_on_status=False leaves the final response for raise_for_status(), so callers see an HTTPError
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False
+        )
+    ))
+
+configure_session()
+
+def load_cache(path):
+    """
+    Load previously fetched metrics and entitlements from the on-disk cache.
+    Returns an empty cache if the file is missing or unreadable.
+    """
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        cache = {}
+    except (OSError, ValueError) as e:
+        logging.warning("Ignoring unreadable cache file %s: %s", path, e)
+        cache = {}
+
+    if not isinstance(cache, dict):
+        logging.warning("Ignoring unreadable cache file %s: expected a JSON object", path)
+        cache = {}
+
+    cache.setdefault("metrics", {})
+    cache.setdefault("entitlements", {})
+    logging.debug("Loaded %s cached metrics from %s", len(cache["metrics"]), path)
+    return cache
+
+def save_cache(cache, path):
+    """
+    Write the metrics and entitlements cache to disk.
+    Failures are logged and ignored, since the cache is only an optimisation.
+    """
+    # Write to a temporary file and swap it in so an interrupted write can't truncate the cache
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.warning("Could not write cache file %s: %s", path, e)
+        return
+    logging.debug("Saved %s cached metrics to %s", len(cache["metrics"]), path)
 
 def fetch_entitlement_keys(namespace, repo):
     """
     Fetch entitlement keys for the given repository.
     """
     url = f"{BASE_URL}/entitlements/{namespace}/{repo}/"
-    headers = {"Authorization": f"Bearer {API_TOKEN}"}
 
-    logging.debug(f"Fetching entitlement keys from: {url}")
-    response = requests.get(url, headers=headers)
+    logging.debug("Fetching entitlement keys from: %s", url)
+    response = SESSION.get(url)
     response.raise_for_status()
     return response.json()
 
+def get_entitlements(namespace, repo, cache=None):
+    """
+    Return the entitlement keys for the given repository, reusing the cached
+    list if it was fetched within ENTITLEMENTS_CACHE_TTL. Only the
+    ENTITLEMENT_CACHE_FIELDS of each entitlement are cached.
+    """
+    cache_key = f"{namespace}/{repo}"
+    if cache is not None:
+        cached = cache["entitlements"].get(cache_key)
+        if cached and time.time() - cached["fetched_at"] < ENTITLEMENTS_CACHE_TTL:
+            logging.debug("Using cached entitlement keys for %s", cache_key)
+            return cached["entitlements"]
+
+    entitlements = fetch_entitlement_keys(namespace, repo)
+    if cache is not None:
+        cache["entitlements"][cache_key] = {
+            "fetched_at": time.time(),
+            "entitlements": [
+                {field: entitlement[field] for field in ENTITLEMENT_CACHE_FIELDS if field in entitlement}
+                for entitlement in entitlements
+            ]
+        }
+    return entitlements
+
 def fetch_usage_metrics(namespace, repo, token, start, finish):
     """
     Fetch usage metrics for a specific entitlement token.
-    Returns the total number of downloads for the given date range.
+    Returns the total number of downloads for the given date range,
+    or None if the API has no metrics for the token.
     """
     url = f"{BASE_URL}/metrics/entitlements/{namespace}/{repo}/"
-    headers = {"Authorization": f"Bearer {API_TOKEN}"}
     params = {
         "tokens": token,
         "start": start,
         "finish": finish
     }
 
-    logging.debug(f"Fetching usage metrics from: {url} with params: {params}")
-    response = requests.get(url, headers=headers, params=params)
+    logging.debug("Fetching usage metrics from: %s with params: %s", url, params)
+    response = SESSION.get(url, params=params)
     if response.status_code == 404:
-        logging.warning(f"No usage metrics found for entitlement token: {token}")
-        return 0
+        logging.warning("No usage metrics found for entitlement token: %s", token)
+        return None
     response.raise_for_status()
     metrics = response.json()
 
     # Extract total downloads from the response structure
     # Response format: {"tokens": {"downloads": {"total": {"value": N}}}}
     total_downloads = metrics.get("tokens", {}).get("downloads", {}).get("total", {}).get("value", 0)
-    logging.debug(f"Total downloads for {token} from {start} to {finish}: {total_downloads}")
+    logging.debug("Total downloads for %s from %s to %s: %s", token, start, finish, total_downloads)
     return total_downloads
 
-def get_layer_pulls(namespace, repo, months):
+def get_months_list(months):
     """
-    Fetch entitlement keys and count downloads per month.
-    Makes separate API calls for each month to get monthly breakdowns.
+    Build the list of months to report on, in chronological order.
+    Each entry has the month key (YYYY-MM) and its first and last day (YYYY-MM-DD).
     """
-    pulls_data = defaultdict(lambda: defaultdict(int))
     end_date = datetime.now(timezone.utc)
 
-    # Fetch all entitlement keys
-    logging.info(f"Fetching entitlement keys for repository: {namespace}/{repo}")
-    entitlements = fetch_entitlement_keys(namespace, repo)
-
-    if not entitlements:
-        logging.warning("No entitlement keys found.")
-        return pulls_data
-
-    logging.info(f"Found {len(entitlements)} entitlement keys.")
-
-    # Generate list of months to query
     months_list = []
     for i in range(months):
-        month_date = end_date - timedelta(days=i * 30)
-        # Get the first day of the month
-        first_day = month_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        # Get the last day of the month (first day of next month minus one day)
-        if first_day.month == 12:
-            last_day = first_day.replace(year=first_day.year + 1, month=1) - timedelta(days=1)
-        else:
-            last_day = first_day.replace(month=first_day.month + 1) - timedelta(days=1)
-        last_day = last_day.replace(hour=23, minute=59, second=59)
-
-        month_key = first_day.strftime("%Y-%m")
+        # Step back whole calendar months; fixed 30-day steps drift and can skip or repeat a month
+        year, month_index = divmod(end_date.year * 12 + end_date.month - 1 - i, 12)
+        month = month_index + 1
+        last_day_of_month = calendar.monthrange(year, month)[1]
+
         months_list.append({
-            "key": month_key,
-            "start": first_day.strftime("%Y-%m-%d"),
-            "finish": last_day.strftime("%Y-%m-%d")
+            "key": f"{year:04d}-{month:02d}",
+            "start": f"{year:04d}-{month:02d}-01",
+            "finish": f"{year:04d}-{month:02d}-{last_day_of_month:02d}"
         })
 
-    months_list.reverse()  # Process in chronological order
+    months_list.reverse()  # Order chronologically
+    return months_list
 
-    # For each entitlement token, fetch metrics for each month
-    for entitlement in entitlements:
-        token = entitlement["slug_perm"]
-        token_name = entitlement.get("name", token)
-        logging.info(f"Processing entitlement: {token_name} ({token})")
+def get_layer_pulls(namespace, repo, months_list, workers=MAX_WORKERS, cache=None):
+    """
+    Fetch entitlement keys and count downloads for each month in months_list.
+    Makes separate API calls for each month to get monthly breakdowns,
+    issued concurrently across a thread pool.
+    Totals for months that ended more than METRICS_CACHE_GRACE_DAYS ago are
+    read from and stored in the cache, if one is given, since they can no
+    longer change. The entitlement list is cached for ENTITLEMENTS_CACHE_TTL.
+    """
+    pulls_data = defaultdict(lambda: defaultdict(int))
+    # Months finishing before this date are closed and safe to cache
+    cache_cutoff_str = (datetime.now(timezone.utc) - timedelta(days=METRICS_CACHE_GRACE_DAYS)).strftime("%Y-%m-%d")
 
-        for month_info in months_list:
-            month_key = month_info["key"]
-            start_str = month_info["start"]
-            finish_str = month_info["finish"]
+    # Fetch all entitlement keys
+    logging.info(f"Fetching entitlement keys for repository: {namespace}/{repo}")
+    entitlements = get_entitlements(namespace, repo, cache)
 
-            logging.debug(f"  Fetching metrics for {month_key} (from {start_str} to {finish_str})")
+    if not entitlements:
+        logging.warning("No entitlement keys found.")
+        return pulls_data
 
-            # Fetch usage metrics for this token and month
-            total_downloads = fetch_usage_metrics(namespace, repo, token, start_str, finish_str)
-            # Use token name as the key instead of token slug
-            pulls_data[token_name][month_key] = total_downloads
+    logging.info(f"Found {len(entitlements)} entitlement keys.")
 
-            logging.debug(f"    Downloads: {total_downloads}")
+    # Flat (token name, month key, downloads) records in (entitlement, month) order,
+    # aggregated once all requests complete
+    records = []
+
+    # Fetch metrics for every (token, month) pair concurrently
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for entitlement in entitlements:
+            token = entitlement["slug_perm"]
+            token_name = entitlement.get("name", token)
+            # ISO date (YYYY-MM-DD) the token was created, used to skip months before it existed
+            created_date = (entitlement.get("created_at") or "")[:10]
+            logging.info(f"Processing entitlement: {token_name} ({token})")
+
+            for month_info in months_list:
+                month_key = month_info["key"]
+                start_str = month_info["start"]
+                finish_str = month_info["finish"]
+
+                if created_date > finish_str:
+                    # Token did not exist yet, so there can be no downloads this month
+                    records.append((token_name, month_key, 0))
+                    continue
+
+                cache_key = f"{namespace}/{repo}/{token}/{start_str}/{finish_str}"
+                if cache is not None and cache_key in cache["metrics"]:
+                    logging.debug("  Using cached metrics for %s", month_key)
+                    records.append((token_name, month_key, cache["metrics"][cache_key]))
+                    continue
+
+                logging.debug("  Fetching metrics for %s (from %s to %s)", month_key, start_str, finish_str)
+
+                future = executor.submit(fetch_usage_metrics, namespace, repo, token, start_str, finish_str)
+                # Reserve this record's slot so results land in submission order, not completion order
+                futures[future] = (len(records), token_name, month_key, cache_key, finish_str)
+                records.append(None)
+
+        # Collect results in the main thread
+        try:
+            for future in as_completed(futures):
+                index, token_name, month_key, cache_key, finish_str = futures[future]
+                total_downloads = future.result()
+                if total_downloads is None:
+                    # Not cached: a 404 may be transient, so only real totals are kept
+                    total_downloads = 0
+                elif cache is not None and finish_str < cache_cutoff_str:
+                    # Recent months may still be accumulating or aggregating downloads
+                    cache["metrics"][cache_key] = total_downloads
+                records[index] = (token_name, month_key, total_downloads)
+
+                logging.debug("    Downloads for %s in %s: %s", token_name, month_key, total_downloads)
+        except BaseException:
+            # Don't keep sending the queued requests once one has failed
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    # Use token name as the key instead of token slug; records are in (entitlement, month)
+    # order, so as before the last entitlement with a given name wins
+    for token_name, month_key, total_downloads in records:
+        pulls_data[token_name][month_key] = total_downloads
 
     logging.info(f"Completed processing all entitlements.")
     return pulls_data
 
-def write_csv(pulls_data, months, output_file):
+def write_csv(pulls_data, months_list, output_file):
     """
-    Write download data to a CSV file.
+    Write download data to a CSV file, with one column per month in months_list.
+    Returns False without creating the file if there is no data.
     """
-    end_date = datetime.now(timezone.utc)
+    if not pulls_data:
+        logging.warning("No download data; skipping CSV write.")
+        return False
 
-    # Generate proper list of month keys
-    months_list = []
-    for i in range(months):
-        month_date = end_date - timedelta(days=i * 30)
-        first_day = month_date.replace(day=1)
-        month_key = first_day.strftime("%Y-%m")
-        months_list.append(month_key)
-
-    months_list.reverse()  # Order chronologically
+    month_keys = [month_info["key"] for month_info in months_list]
 
     logging.info(f"Writing data to CSV file: {output_file}")
     with open(output_file, "w", newline="") as csvfile:
         writer = csv.writer(csvfile)
-        writer.writerow(["Entitlement Name"] + months_list)
-
-        for token_name, month_data in pulls_data.items():
-            row = [token_name] + [month_data.get(month, 0) for month in months_list]
-            writer.writerow(row)
+        writer.writerow(["Entitlement Name"] + month_keys)
+        writer.writerows(
+            [token_name] + [month_data.get(month, 0) for month in month_keys]
+            for token_name, month_data in pulls_data.items()
+        )
 
     logging.info(f"CSV file written successfully: {output_file}")
+    return True
 
 if __name__ == "__main__":
     # Parse command-line arguments
@@ -158,6 +299,8 @@ Examples:
   %(prog)s tetrate/tid-fips-containers
   %(prog)s tetrate/tid-fips-containers --months 12
   %(prog)s tetrate/tid-fips-containers --months 6 --output my_metrics.csv
+  %(prog)s tetrate/tid-fips-containers --workers 8
+  %(prog)s tetrate/tid-fips-containers --no-cache
         """
     )
     parser.add_argument(
@@ -175,6 +318,22 @@ Examples:
         default="entitlement_downloads.csv",
         help="Output CSV file path (default: entitlement_downloads.csv)"
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=MAX_WORKERS,
+        help=f"Number of concurrent API requests (default: {MAX_WORKERS})"
+    )
+    parser.add_argument(
+        "--cache-file",
+        default=CACHE_FILE,
+        help=f"Cache file for entitlements and metrics of completed months (default: {CACHE_FILE})"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Fetch all metrics from the API without reading or writing the cache"
+    )
 
     args = parser.parse_args()
 
@@ -183,6 +342,11 @@ Examples:
         logging.error("API_TOKEN not found in .env file.")
         exit(1)
 
+    if args.workers < 1:
+        logging.error("--workers must be at least 1")
+        exit(1)
+    configure_session(args.workers)
+
     # Validate repository format
     if "/" not in args.repository:
         logging.error("Repository must be in format: namespace/repo (e.g., tetrate/tid-fips-containers)")
@@ -199,9 +363,16 @@ Examples:
     try:
         logging.info(f"Starting metrics collection for {args.repository}")
         logging.info(f"Analyzing {args.months} months of data")
-        pulls_data = get_layer_pulls(namespace, repo, args.months)
-        write_csv(pulls_data, args.months, args.output)
-        logging.info(f"Successfully generated {args.output}")
+        months_list = get_months_list(args.months)
+        cache = None if args.no_cache else load_cache(args.cache_file)
+        try:
+            pulls_data = get_layer_pulls(namespace, repo, months_list, args.workers, cache)
+        finally:
+            # Keep the months fetched so far even if a later request failed
+            if cache is not None:
+                save_cache(cache, args.cache_file)
+        if write_csv(pulls_data, months_list, args.output):
+            logging.info(f"Successfully generated {args.output}")
     except requests.HTTPError as e:
         logging.error(f"HTTP Error: {e}")
         exit(1)